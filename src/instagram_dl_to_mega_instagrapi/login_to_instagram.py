@@ -4,10 +4,10 @@ import logging
 from pprint import pformat
 
 from instagrapi import Client
-from mega import Mega
 
 from gist_api import Gist
 from instagram_dl_to_mega_instagrapi.load_creds import load_instagram_creds
+from instagram_dl_to_mega_instagrapi.storage_backend import StorageBackend
 
 
 logger = logging.getLogger(__name__)
@@ -77,6 +77,8 @@ class LoginNotAllowedError(RuntimeError):
 class LoginManager():
     no_logins_before: 'int|float' = None
     reason_str: str = None
+    # the cached instagrapi settings, kept in the same Gist
+    settings: dict = None
     _was_loaded_this_session = False
 
     @classmethod
@@ -108,13 +110,15 @@ class LoginManager():
     def _to_json(cls):
         return {
             'ts': cls.no_logins_before,
-            'reason': cls.reason_str
+            'reason': cls.reason_str,
+            'settings': cls.settings
         }
 
     @classmethod
     def _from_json(cls, json_dict: dict):
         cls.no_logins_before = json_dict.get('ts')
         cls.reason_str = json_dict.get('reason')
+        cls.settings = json_dict.get('settings')
 
     @classmethod
     def load(cls):
@@ -135,33 +139,42 @@ class LoginManager():
             logger.info(Gist('LOGINMGR').write(json.dumps(cls._to_json())))
 
 
-def _after_new_login(client: Client, new_settings_file, mega: Mega, delete_old_settingsfile=None):
-    client.dump_settings(new_settings_file)
-    logger.info(f'Saved locally: {new_settings_file}')
-    mega.upload(new_settings_file)
-    logger.info(f'Uploaded to MEGA: {new_settings_file}')
-    if delete_old_settingsfile is not None:
-        mega.delete(delete_old_settingsfile)
-        logger.info(f'Deleted old settings file on MEGA.')
+SETTINGS_FILE_NAME = 'cached_instagrapi-dl-to-mega_settings.json'
 
 
-def login_to_instagram(client: Client, mega: Mega):
+def download_settings(storage: StorageBackend) -> 'dict|None':
+    """Download the instagrapi settings cached on the storage by older versions."""
+    if not storage.get(SETTINGS_FILE_NAME, SETTINGS_FILE_NAME):
+        # settings file does not exist
+        logger.info('Unable to find file: %s', SETTINGS_FILE_NAME)
+        return None
+    logger.info('Downloaded from %s: %s', storage.name, SETTINGS_FILE_NAME)
+    try:
+        with open(SETTINGS_FILE_NAME, encoding='utf-8') as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return None
+
+
+def login_to_instagram(client: Client, storage: StorageBackend):
+    """Log in to Instagram, reusing the cached settings if possible.
+
+    The settings are cached in the LoginManager's Gist, which has to be
+    loaded beforehand; they are written back with `LoginManager.dump`.
+    """
     LoginManager.check_if_login_is_allowed()
     username, password = load_instagram_creds()
-    settings_file_name = 'cached_instagrapi-dl-to-mega_settings.json'
-    settings_file = mega.find(settings_file_name, exclude_deleted=True)
-    if settings_file is None:
-        # settings file does not exist
-        logger.info(f'Unable to find file: {settings_file_name}')
+    settings = LoginManager.settings
+    if settings is None:
+        # not migrated to the Gist yet
+        settings = download_settings(storage)
+    if settings is None:
         client.set_device(DEVICE_SETTINGS)
         client.login(username, password)
-        _after_new_login(client, settings_file_name, mega)
     else:
-        # settings file does exist, download and read it
-        mega.download(settings_file)
-        logger.info(f'Downloaded from MEGA: {settings_file_name}')
-        client.load_settings(settings_file_name)
-        logger.info(f'Reusing settings: {settings_file_name}')
+        client.set_settings(settings)
+        logger.info('Reusing the cached settings.')
         client.login(username, password)
+    LoginManager.settings = client.get_settings()
 
-    logger.info(f'Logged in as user ID {client.user_id}.')
+    logger.info('Logged in as user ID %s.', client.user_id)
@@ -1,42 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
 import sys
 import time
 
 from gist_api import Gist
 from instagrapi import Client
-from mega import Mega
 
 from instagram_dl_to_mega_instagrapi.handle_exceptions import handle_exception
 from instagram_dl_to_mega_instagrapi.login_to_instagram import LoginManager, login_to_instagram
-from instagram_dl_to_mega_instagrapi.login_to_mega import storage_threshold_exceeded, login_to_mega
-from instagram_dl_to_mega_instagrapi.setup_logging import setup_logging
+from instagram_dl_to_mega_instagrapi.media_processing import MediaProcessor, ProcessingOptions
+from instagram_dl_to_mega_instagrapi.setup_logging import setup_logging, shutdown_logging
+from instagram_dl_to_mega_instagrapi.staging import TempSpaceBudget
+from instagram_dl_to_mega_instagrapi.storage_backend import (
+    StorageBackend, open_storage_backend, storage_threshold_exceeded
+)
 from instagram_dl_to_mega_instagrapi.story_saver import StorySaver
 
 logger = logging.getLogger(__name__)
 
 
 def main():
-    setup_logging()
-    logger.info(f'Started main.py: {time.asctime(time.gmtime())}')
+    setup_logging(debug=os.getenv('LOG_DEBUG', '').lower() in ('1', 'true', 'yes'))
+    try:
+        _main()
+    except Exception as exc:
+        logger.exception(exc)
+        logger.info('Canceled program due to uncaught error.')
+        raise
+    finally:
+        # the queued records are lost unless they are processed here, also
+        # on sys.exit() and on errors outside of _main's own error handling
+        shutdown_logging()
+
+
+def _main():
+    logger.info('Started main.py: %s', time.asctime(time.gmtime()))
+
+    # the Gist round trip (which also fetches the cached instagrapi settings)
+    # is independent of the storage ones, so run it in the background until
+    # the Instagram login needs it; the storage calls themselves stay
+    # sequential, because e.g. the Mega object is not safe to share between
+    # threads
+    executor = ThreadPoolExecutor(max_workers=1)
+    loginmgr_future = executor.submit(LoginManager.load)
+    executor.shutdown(wait=False)
 
-    mega = login_to_mega()
-    storage_threshold_msg = storage_threshold_exceeded(mega, 0.95)
+    storage = open_storage_backend()
+    storage_threshold_msg = storage_threshold_exceeded(storage, 0.95)
     if storage_threshold_msg:
         logger.critical(storage_threshold_msg)
-        _cleanup_and_exit(mega, 1)
+        _cleanup_and_exit(storage, 1)
 
-    LoginManager.load()
     try:
+        loginmgr_future.result()
         cl = Client()
-        login_to_instagram(cl, mega)
+        login_to_instagram(cl, storage)
         cl.handle_exception = handle_exception
-        for userid in _get_userids():
-            StorySaver(cl, mega, userid).save()
+        budget = TempSpaceBudget.from_env()
+        with MediaProcessor(ProcessingOptions.from_env()) as processor:
+            for userid in _get_userids():
+                StorySaver(cl, storage, userid, processor, budget).save()
     except Exception as exc:
         logger.exception(exc)
         logger.info('Canceled program due to error.')
-        _cleanup_and_exit(mega, 1)
-    _cleanup_and_exit(mega)
+        _cleanup_and_exit(storage, 1)
+    _cleanup_and_exit(storage)
 
 
 def _get_userids():
@@ -52,13 +81,13 @@ def _get_userids():
     # 46693997484     codetekt
     for userid in sys.argv[1:]:
         if not userid.isdigit():
-            logger.warning(f'Skipped invalid user ID "{userid}"!')
+            logger.warning('Skipped invalid user ID "%s"!', userid)
         else:
             yield userid
 
 
-def _cleanup_and_exit(mega: Mega, exitcode: int = 0):
+def _cleanup_and_exit(storage: StorageBackend, exitcode: int = 0):
     LoginManager.dump()
-    mega.logout_session()
-    logger.info(f'Exiting program with code {exitcode}.')
+    storage.close()
+    logger.info('Exiting program with code %d.', exitcode)
     sys.exit(exitcode)
@@ -0,0 +1,223 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+import logging
+import os
+import shutil
+import subprocess
+import time
+from typing import NamedTuple
+
+from instagram_dl_to_mega_instagrapi.staging import StagedAsset, TempSpaceExhaustedError
+
+
+logger = logging.getLogger(__name__)
+
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, '').lower() in ('1', 'true', 'yes')
+
+
+class ProcessingOptions(NamedTuple):
+    optimize_jpeg: bool = False
+    # e.g. 'libx265'; 'copy' only remuxes, None leaves videos untouched
+    video_codec: 'str|None' = None
+    video_crf: int = 28
+    drop_video_cover: bool = False
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            optimize_jpeg=_env_flag('OPTIMIZE_JPEG'),
+            video_codec=os.getenv('VIDEO_CODEC') or None,
+            video_crf=int(os.getenv('VIDEO_CRF', cls._field_defaults['video_crf'])),
+            drop_video_cover=_env_flag('DROP_VIDEO_COVER'),
+        )
+
+
+class ProcessingResult(NamedTuple):
+    name: str
+    size_before: int
+    size_after: int
+    seconds: float
+
+
+def _replace_if_smaller(filename: str, processed_filename: str, start: float) -> ProcessingResult:
+    """Keep the processed file instead of the original, but only if it is smaller."""
+    size_before = os.path.getsize(filename)
+    size_after = os.path.getsize(processed_filename)
+    if size_after < size_before:
+        os.replace(processed_filename, filename)
+    else:
+        os.remove(processed_filename)
+        size_after = size_before
+    return ProcessingResult(filename, size_before, size_after, time.monotonic() - start)
+
+
+def optimize_jpeg_data(name: str, data: bytes) -> 'tuple[bytes, ProcessingResult]':
+    """Losslessly optimize the in-memory JPEG using jpegtran.
+
+    Return the smaller of the original and the optimized data.
+    """
+    start = time.monotonic()
+    processed = subprocess.run(
+        ['jpegtran', '-copy', 'all', '-optimize', '-progressive'],
+        input=data, check=True, capture_output=True
+    ).stdout
+    if len(processed) >= len(data):
+        processed = data
+    return processed, ProcessingResult(name, len(data), len(processed), time.monotonic() - start)
+
+
+def optimize_jpeg(filename: str) -> ProcessingResult:
+    """Losslessly optimize the JPEG file in place using jpegtran."""
+    start = time.monotonic()
+    processed_filename = filename + '.optimized.jpg'
+    subprocess.run(
+        [
+            'jpegtran', '-copy', 'all', '-optimize', '-progressive',
+            '-outfile', processed_filename, filename
+        ],
+        check=True, capture_output=True
+    )
+    return _replace_if_smaller(filename, processed_filename, start)
+
+
+def transcode_video(filename: str, codec: str, crf: int) -> ProcessingResult:
+    """Remux (codec 'copy') or re-encode the MP4 file in place using ffmpeg."""
+    start = time.monotonic()
+    processed_filename = filename + '.transcoded.mp4'
+    if codec == 'copy':
+        codec_args = ['-c', 'copy']
+    else:
+        codec_args = ['-c:v', codec, '-crf', str(crf), '-c:a', 'copy']
+    subprocess.run(
+        [
+            'ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', filename,
+            *codec_args, '-map_metadata', '0', '-movflags', '+faststart',
+            processed_filename
+        ],
+        check=True, capture_output=True
+    )
+    return _replace_if_smaller(filename, processed_filename, start)
+
+
+class MediaProcessor():
+    """Optionally process downloaded files before they are uploaded.
+
+    The processing runs in a process pool, so that it overlaps with the
+    downloads and uploads. The savings are logged when the context is left,
+    including the upload time they saved, estimated from the upload
+    throughput reported via `record_upload`.
+    """
+
+    def __init__(self, options: ProcessingOptions):
+        self.options = options
+        self.optimize_jpeg = options.optimize_jpeg and self._tool_available('jpegtran')
+        self.video_codec = options.video_codec if (
+            options.video_codec and self._tool_available('ffmpeg')
+        ) else None
+        self.executor = None
+        self.results = []
+        self.uploaded_bytes = 0
+        self.upload_seconds = 0.0
+
+    def _tool_available(self, tool: str) -> bool:
+        if shutil.which(tool) is None:
+            logger.warning('%s is not available, skipped its processing step.', tool)
+            return False
+        return True
+
+    def __enter__(self):
+        if self.optimize_jpeg or self.video_codec:
+            self.executor = ProcessPoolExecutor()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self._log_summary()
+
+    def submit(self, asset: StagedAsset) -> 'Future|None':
+        """Start processing the asset, depending on its extension.
+
+        Return None if there is nothing to do for this asset.
+        """
+        if self.executor is None:
+            return None
+        if asset.name.endswith('.jpg') and self.optimize_jpeg:
+            if asset.in_memory:
+                return self.executor.submit(optimize_jpeg_data, asset.name, asset.getvalue())
+            if not self._reserve_output(asset):
+                return None
+            return self.executor.submit(optimize_jpeg, asset.filename)
+        if asset.name.endswith('.mp4') and self.video_codec:
+            # ffmpeg needs a file to seek in
+            asset.spill()
+            asset.finish()
+            if not self._reserve_output(asset):
+                return None
+            return self.executor.submit(
+                transcode_video, asset.filename, self.video_codec, self.options.video_crf
+            )
+        return None
+
+    def _reserve_output(self, asset: StagedAsset) -> bool:
+        """Reserve the disk space for the processed file next to the asset.
+
+        Processing is optional, so it is skipped if the budget is exhausted.
+        """
+        try:
+            asset.reserve_output()
+        except TempSpaceExhaustedError as exc:
+            logger.warning('Skipped processing %s: %s', asset.name, exc)
+            return False
+        return True
+
+    def wait(self, future: 'Future|None', asset: StagedAsset):
+        """Wait until the processing is finished and apply its result to the asset.
+
+        A failed processing step is logged, the original asset is used then.
+        """
+        if future is None:
+            return
+        try:
+            if asset.in_memory:
+                data, result = future.result()
+                asset.replace_value(data)
+            else:
+                result = future.result()
+                asset.sync_size()
+        except Exception:
+            logger.exception('Error while processing a file, using the original.', exc_info=True)
+        else:
+            self.results.append(result)
+        finally:
+            # the processed file replaced the asset or was removed by now
+            asset.release_output()
+
+    def record_upload(self, nbytes: int, seconds: float):
+        """Account for an uploaded file, to estimate the upload throughput."""
+        self.uploaded_bytes += nbytes
+        self.upload_seconds += seconds
+
+    def _log_summary(self):
+        if not self.results:
+            return
+        size_before = sum(r.size_before for r in self.results) or 1
+        size_after = sum(r.size_after for r in self.results)
+        seconds = sum(r.seconds for r in self.results)
+        # assume the saved bytes would have been uploaded at the throughput
+        # of the actual uploads
+        upload_seconds_saved = (
+            (size_before - size_after) * self.upload_seconds / self.uploaded_bytes
+        ) if self.uploaded_bytes else 0.0
+        logger.info(
+            'Processed %d files: %d -> %d bytes (saved %.1f%%, about %.1f s of '
+            'upload time) in %.1f s of processing time.',
+            len(self.results), size_before, size_after,
+            100 * (1 - size_after / size_before), upload_seconds_saved, seconds,
+            extra={
+                'files_processed': len(self.results), 'bytes_before': size_before,
+                'bytes_after': size_after, 'processing_seconds': seconds,
+                'upload_seconds_saved': upload_seconds_saved
+            }
+        )
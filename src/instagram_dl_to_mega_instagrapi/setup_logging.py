@@ -1,20 +1,121 @@
+import copy
+from datetime import datetime, timezone
+import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import sys
+
+from gist_api import Gist
 
 logger = logging.getLogger(__name__)
 
+# attributes every LogRecord has, anything else was passed via `extra`
+_STANDARD_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
 
-def setup_logging(debug_on_console: bool = False):
-    rootLogger = logging.getLogger(__name__).parent
-    rootLogger.setLevel(logging.DEBUG)
+_listener: QueueListener = None
+_queue_handler: QueueHandler = None
+_gist_buffer: '_BufferHandler' = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Format each record as a single line of JSON, including its `extra` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        record_dict = {
+            'time': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        record_dict.update(
+            (key, value) for key, value in vars(record).items()
+            if key not in _STANDARD_RECORD_ATTRS
+        )
+        if record.exc_info:
+            record_dict['exception'] = self.formatException(record.exc_info)
+        return json.dumps(record_dict, default=str)
+
+
+class _BufferHandler(logging.Handler):
+    """Keep the formatted records in memory, to write them out all at once."""
+
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.lines = []
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class _LazyQueueHandler(QueueHandler):
+    """Enqueue the records without formatting them in the logging thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # merge the arguments now, because they might be changed before the
+        # listener gets to them, but leave formatting the traceback and
+        # everything else to the handlers in the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(debug: bool = False):
+    """Log to the console and to a buffer for the log Gist, without blocking.
+
+    The loggers only put the records into a queue, the handlers run in the
+    thread of a QueueListener. With `debug`, DEBUG records (e.g. verbose
+    payload dumps) are logged, too; otherwise they are dropped right away.
+    Call `shutdown_logging` at the end to write the buffer to the log Gist.
+    """
+    global _listener, _queue_handler, _gist_buffer
+
+    level = logging.DEBUG if debug else logging.INFO
 
     # create a new handler to print to console
     print_to_console = logging.StreamHandler()
-    print_to_console.setLevel(logging.DEBUG if debug_on_console else logging.INFO)
+    print_to_console.setLevel(level)
+
+    # create a new handler to collect the structured records for the Gist
+    _gist_buffer = _BufferHandler(level)
+    _gist_buffer.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(
+        log_queue, print_to_console, _gist_buffer, respect_handler_level=True
+    )
+    _listener.start()
+    _queue_handler = _LazyQueueHandler(log_queue)
 
     # register handler to logger
-    rootLogger.addHandler(print_to_console)
+    rootLogger = logging.getLogger(__name__).parent
+    rootLogger.setLevel(level)
+    rootLogger.addHandler(_queue_handler)
 
-    # enable warnings from the mega.py library
+    # enable warnings from the mega.py library (they propagate to the root
+    # logger, so the handler must not be added again)
     megalogger = logging.getLogger('mega')
     megalogger.setLevel(logging.WARNING)
-    megalogger.addHandler(print_to_console)
+
+
+def shutdown_logging():
+    """Process the remaining queued records and write the log Gist once.
+
+    Records logged afterwards are no longer queued, they fall back to
+    logging's last resort handler.
+    """
+    global _listener
+    if _listener is None:
+        return
+    logging.getLogger(__name__).parent.removeHandler(_queue_handler)
+    _listener.stop()
+    _listener = None
+    try:
+        Gist('LOG').write('\n'.join(_gist_buffer.lines))
+    except Exception as exc:
+        # the logging pipeline is already stopped at this point
+        print(f'Unable to write the log Gist: {exc!r}', file=sys.stderr)
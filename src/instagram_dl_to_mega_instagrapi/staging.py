@@ -0,0 +1,197 @@
+import io
+import os
+import shutil
+import tempfile
+
+
+class TempSpaceExhaustedError(RuntimeError):
+    def __init__(self, nbytes: int, available: int, total: int):
+        self.nbytes = nbytes
+        self.available = available
+        self.total = total
+
+    def __str__(self):
+        return (
+            f'Unable to stage {self.nbytes} more bytes on disk, only '
+            f'{self.available} of {self.total} bytes are available.'
+        )
+
+
+class TempSpaceBudget():
+    """Limit the disk space used by the staged assets of all users together.
+
+    The users are saved one after another in a single thread, so nothing
+    could free space while waiting; reserving fails right away instead.
+    Assets up to `memory_threshold` bytes are kept in memory and do not
+    count towards the budget.
+    """
+
+    def __init__(self, total: int, memory_threshold: int):
+        self.total = total
+        self.available = total
+        self.memory_threshold = memory_threshold
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            total=int(os.getenv('STAGING_DISK_BUDGET', 2 * 1024 ** 3)),
+            memory_threshold=int(os.getenv('STAGING_MEMORY_THRESHOLD', 1024 * 1024)),
+        )
+
+    def reserve(self, nbytes: int):
+        if nbytes > self.available:
+            raise TempSpaceExhaustedError(nbytes, self.available, self.total)
+        self.available -= nbytes
+
+    def release(self, nbytes: int):
+        self.available += nbytes
+
+
+class StagedAsset():
+    """A downloaded file which waits to be processed and uploaded.
+
+    It is kept in memory while it is small and spilled to disk once it grows
+    beyond the memory threshold. Call `release` as soon as it was uploaded.
+    """
+
+    def __init__(self, area: 'StagingArea', name: str, expected_size: 'int|None' = None):
+        self.area = area
+        self.name = name
+        self.size = 0
+        self.filename = None  # only set once the asset is on disk
+        self._buffer = io.BytesIO()
+        self._file = None
+        self._reserved = 0
+        self._reserved_for_output = 0
+        if not area.in_memory:
+            self.spill(expected_size or 0)
+        elif expected_size is not None and expected_size > area.budget.memory_threshold:
+            # it is going to be spilled anyway, so write to disk right away
+            self.spill(expected_size)
+
+    @property
+    def in_memory(self) -> bool:
+        return self.filename is None
+
+    def _reserve_up_to(self, nbytes: int):
+        if nbytes > self._reserved:
+            self.area.budget.reserve(nbytes - self._reserved)
+            self._reserved = nbytes
+
+    def write(self, data: bytes):
+        if self.in_memory and self.size + len(data) > self.area.budget.memory_threshold:
+            self.spill(self.size + len(data))
+        if self.in_memory:
+            self._buffer.write(data)
+        else:
+            self._reserve_up_to(self.size + len(data))
+            self._file.write(data)
+        self.size += len(data)
+
+    def spill(self, expected_size: int = 0):
+        """Move the asset to disk, e.g. because a tool needs it as a file."""
+        if not self.in_memory:
+            return
+        self._reserve_up_to(max(expected_size, self.size))
+        self.filename = os.path.join(self.area.dirname(), self.name)
+        self._file = open(self.filename, 'wb')
+        self._file.write(self._buffer.getbuffer())
+        self._buffer = None
+
+    def finish(self):
+        """Finish writing, the asset can be processed and uploaded afterwards."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            # release what was reserved for an expected size that was not reached
+            self.sync_size()
+
+    def sync_size(self):
+        """Update the reserved disk space after the file was changed in place."""
+        self.size = os.path.getsize(self.filename)
+        if self.size < self._reserved:
+            self.area.budget.release(self._reserved - self.size)
+            self._reserved = self.size
+        else:
+            self._reserve_up_to(self.size)
+
+    def reserve_output(self):
+        """Reserve disk space for a processed copy of the asset on disk.
+
+        The copy is assumed to be at most as large as the asset; call
+        `release_output` once it replaced the asset or was removed.
+        """
+        self.area.budget.reserve(self.size)
+        self._reserved_for_output += self.size
+
+    def release_output(self):
+        self.area.budget.release(self._reserved_for_output)
+        self._reserved_for_output = 0
+
+    def getvalue(self) -> bytes:
+        return self._buffer.getvalue()
+
+    def replace_value(self, data: bytes):
+        """Replace the content of an in-memory asset, e.g. after processing."""
+        self._buffer = io.BytesIO(data)
+        self.size = len(data)
+
+    def reader(self) -> io.BytesIO:
+        """Return the in-memory content as a stream, without copying it."""
+        self._buffer.seek(0)
+        return self._buffer
+
+    def release(self):
+        """Free the memory or the disk space of the asset."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.filename is not None:
+            try:
+                os.remove(self.filename)
+            except FileNotFoundError:
+                pass
+        self._buffer = None
+        self.release_output()
+        self.area.budget.release(self._reserved)
+        self._reserved = 0
+        self.area.assets.discard(self)
+
+
+class StagingArea():
+    """Stage the downloaded files of a user before they are uploaded.
+
+    The temporary directory is only created once the first asset has to be
+    spilled to disk. Without `in_memory`, all assets are written to disk
+    right away, e.g. if they can only be uploaded from files anyway. Assets
+    which were not released yet are released on exit.
+    """
+
+    def __init__(self, child: str, budget: TempSpaceBudget, in_memory: bool = True):
+        # e.g. /tmp/igstories_...
+        self._dirname = os.path.join(tempfile.gettempdir(), child)
+        self.budget = budget
+        self.in_memory = in_memory
+        self._dir_created = False
+        self.assets = set()
+
+    def dirname(self) -> str:
+        if not self._dir_created:
+            # the directory might already exist for whatever reason, no problem
+            os.makedirs(self._dirname, exist_ok=True)
+            self._dir_created = True
+        return self._dirname
+
+    def stage(self, name: str, expected_size: 'int|None' = None) -> StagedAsset:
+        asset = StagedAsset(self, name, expected_size)
+        self.assets.add(asset)
+        return asset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        for asset in list(self.assets):
+            asset.release()
+        if self._dir_created:
+            shutil.rmtree(self._dirname, ignore_errors=True)
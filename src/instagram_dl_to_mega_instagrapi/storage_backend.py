@@ -0,0 +1,217 @@
+from abc import ABC, abstractmethod
+import logging
+import os
+import posixpath
+import shutil
+import tempfile
+from typing import TYPE_CHECKING, BinaryIO, Iterable
+
+if TYPE_CHECKING:
+    # only MegaStorage needs mega.py, which is imported on demand
+    from mega import Mega
+
+
+logger = logging.getLogger(__name__)
+
+
+class StorageBackend(ABC):
+    """Interface for the places where the stories are archived.
+
+    Paths are relative and separated by slashes, e.g. 'folder/file.json'.
+    Missing parent folders are created on demand.
+    """
+
+    name: str = None
+    # True if uploading requires a local file, e.g. because put_stream has
+    # to write the stream to a temporary file first
+    uploads_from_files: bool = False
+
+    def exists(self, path: str) -> bool:
+        return path in self.exists_many([path])
+
+    @abstractmethod
+    def exists_many(self, paths: Iterable[str]) -> 'set[str]':
+        """Return the subset of the given paths which already exist."""
+
+    @abstractmethod
+    def put_stream(self, path: str, stream: BinaryIO):
+        """Store the data read from the given binary stream at the path."""
+
+    def put_file(self, path: str, local_filename: str):
+        """Store the content of the given local file at the path."""
+        with open(local_filename, 'rb') as f:
+            self.put_stream(path, f)
+
+    @abstractmethod
+    def get(self, path: str, local_filename: str) -> bool:
+        """Save the file at the path to the given local file.
+
+        Return False if there is no such file.
+        """
+
+    @abstractmethod
+    def delete(self, path: str):
+        """Delete the file at the path, if there is one."""
+
+    @abstractmethod
+    def space_usage(self) -> 'dict[str, int]':
+        """Return the used and the total storage space in bytes."""
+
+    def close(self):
+        pass
+
+
+class MegaStorage(StorageBackend):
+    name = 'MEGA'
+    uploads_from_files = True
+
+    def __init__(self, mega: 'Mega'):
+        self.mega = mega
+        self._folder_node_ids = {}
+
+    def _folder_node_id(self, folder: str) -> 'str|None':
+        """Get the node ID of the folder, create the folder if necessary."""
+        if not folder:
+            # top level, mega.upload() defaults to the root folder
+            return None
+        if folder not in self._folder_node_ids:
+            found = self.mega.find(folder, exclude_deleted=True)
+            if found is None:
+                # folder does not exist, so create it
+                node_ids = self.mega.create_folder(folder)
+                logger.info('Created new folder: %s', folder)
+                self._folder_node_ids[folder] = node_ids[posixpath.basename(folder)]
+            else:
+                self._folder_node_ids[folder] = found[0]
+        return self._folder_node_ids[folder]
+
+    def exists_many(self, paths: Iterable[str]) -> 'set[str]':
+        # mega.find() fetches the whole file tree on every call, so fetch it
+        # only once and look up all files of a folder in it
+        files = self.mega.get_files()
+        existing = set()
+        names_by_folder = {}
+        for path in paths:
+            folder, name = posixpath.split(path)
+            if folder not in names_by_folder:
+                # the root folder's ID is known once get_files() was called
+                folder_node_id = self.mega.find_path_descriptor(
+                    folder, files=files
+                ) if folder else self.mega.root_id
+                names_by_folder[folder] = {
+                    node['a']['n'] for node in files.values()
+                    if node['a'] and node['p'] == folder_node_id
+                } if folder_node_id is not None else set()
+            if name in names_by_folder[folder]:
+                existing.add(path)
+        return existing
+
+    def put_stream(self, path: str, stream: BinaryIO):
+        # mega.upload() can only read from a file on disk
+        with tempfile.TemporaryDirectory() as tmpdir:
+            local_filename = os.path.join(tmpdir, posixpath.basename(path))
+            with open(local_filename, 'wb') as f:
+                shutil.copyfileobj(stream, f)
+            self.put_file(path, local_filename)
+
+    def put_file(self, path: str, local_filename: str):
+        # mega.find() must be called with 'folder/file.txt', but mega.upload()
+        # must be called with dest='node_id_of_folder', dest_filename='file.txt'
+        folder, name = posixpath.split(path)
+        self.mega.upload(
+            local_filename, dest=self._folder_node_id(folder), dest_filename=name
+        )
+
+    def get(self, path: str, local_filename: str) -> bool:
+        found = self.mega.find(path, exclude_deleted=True)
+        if found is None:
+            return False
+        dest_path, dest_filename = os.path.split(local_filename)
+        self.mega.download(found, dest_path=dest_path or None, dest_filename=dest_filename)
+        return True
+
+    def delete(self, path: str):
+        found = self.mega.find(path, exclude_deleted=True)
+        if found is not None:
+            self.mega.delete(found[0])
+
+    def space_usage(self) -> 'dict[str, int]':
+        storage_space = self.mega.get_storage_space()
+        return {'used': storage_space['used'], 'total': storage_space['total']}
+
+    def close(self):
+        self.mega.logout_session()
+
+
+class LocalStorage(StorageBackend):
+    name = 'local storage'
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def _local_path(self, path: str) -> str:
+        return os.path.join(self.root, *path.split('/'))
+
+    def exists_many(self, paths: Iterable[str]) -> 'set[str]':
+        return {path for path in paths if os.path.isfile(self._local_path(path))}
+
+    def put_stream(self, path: str, stream: BinaryIO):
+        local_path = self._local_path(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        # write to a temporary file next to the target first, so that an
+        # interrupted write does not leave a file that seems to exist
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(local_path), delete=False
+        ) as f:
+            try:
+                shutil.copyfileobj(stream, f)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        # NamedTemporaryFile creates the file with mode 0600
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, local_path)
+
+    def get(self, path: str, local_filename: str) -> bool:
+        try:
+            shutil.copyfile(self._local_path(path), local_filename)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def delete(self, path: str):
+        try:
+            os.remove(self._local_path(path))
+        except FileNotFoundError:
+            pass
+
+    def space_usage(self) -> 'dict[str, int]':
+        usage = shutil.disk_usage(self.root)
+        return {'used': usage.used, 'total': usage.total}
+
+
+def open_storage_backend() -> StorageBackend:
+    """Open the storage backend selected by the STORAGE_BACKEND env var.
+
+    'mega' (the default) logs in to MEGA, 'local' archives to the directory
+    given by STORAGE_LOCAL_ROOT.
+    """
+    backend = os.getenv('STORAGE_BACKEND', 'mega')
+    if backend == 'mega':
+        from instagram_dl_to_mega_instagrapi.login_to_mega import login_to_mega
+        return MegaStorage(login_to_mega())
+    if backend == 'local':
+        return LocalStorage(os.getenv('STORAGE_LOCAL_ROOT', 'archive'))
+    raise ValueError(f'Unknown storage backend "{backend}"')
+
+
+def storage_threshold_exceeded(storage: StorageBackend, threshold: float):
+    storage_space = storage.space_usage()
+    if storage_space['used'] / storage_space['total'] > threshold:
+        return (
+            f'There is less than {1 - threshold:.1%} storage space '
+            f'remaining on {storage.name}. Aborted.'
+        )
+    return ''
@@ -1,16 +1,17 @@
+from concurrent.futures import Future
 from datetime import datetime, timezone
 import json
 import logging
-import os
 from pprint import pformat
-import shutil
-import tempfile
 import time
 
-from mega import Mega
 import requests
 
-from instagrapi import Client
+from instagrapi import Client, config
+
+from instagram_dl_to_mega_instagrapi.media_processing import MediaProcessor
+from instagram_dl_to_mega_instagrapi.staging import StagedAsset, StagingArea, TempSpaceBudget
+from instagram_dl_to_mega_instagrapi.storage_backend import StorageBackend
 
 
 CHUNK_SIZE = 4096 # size for chunk-downloading of images and videos
@@ -22,87 +23,82 @@ ISO8601 = '%Y-%m-%dT%H-%M-%SZ'
 logger = logging.getLogger(__name__)
 
 
-class TemporaryLocalDownloadDir():
-    """Prepare temporary download directory.
-
-    The files will be downloaded to this local directory, in order to upload
-    them to MEGA from there.
-    """
-
-    def __init__(self, userpk, username):
-        child = (
-            f'igstories_{userpk}_{username}__'
-            f'{time.strftime(ISO8601, time.gmtime())}'
-        )
-        # e.g. /tmp/igstories_...
-        self.dirname = os.path.join(tempfile.gettempdir(), child)
-
-    def __enter__(self):
-        try:
-            os.mkdir(self.dirname)
-        except FileExistsError:
-            # directory already exists for whatever reason, no problem
-            pass
-        return self.dirname
-
-    def __exit__(self, exc_type, exc_value, exc_traceback):
-        shutil.rmtree(self.dirname)
-
-
 class StorySaver():
-    def __init__(self, api: Client, mega: Mega, userid):
+    def __init__(
+        self, api: Client, storage: StorageBackend, userid,
+        processor: MediaProcessor, budget: TempSpaceBudget
+    ):
         self.api = api
-        self.mega = mega
+        self.storage = storage
+        self.processor = processor
+        self.budget = budget
         self.userid = userid
         userinfo = api.user_info(userid)
         self.username = userinfo.username
         self.userpk = userinfo.pk  # this should be identical to userid
 
 
-    def _get_user_folder_on_mega(self):
-        """Get the folder object for the user on MEGA.
+    def _get_user_folder_name(self):
+        """Set the name of the folder for the user on the storage.
 
-        Set the attribute to the folder object. Create the folder beforehand
-        if necessary.
+        The storage backend creates the folder on the first upload.
         """
-
         self.user_folder_name = f"{self.userpk}_{self.username}"
-        user_folder = self.mega.find(self.user_folder_name, exclude_deleted=True)
-        if user_folder is None:
-            # folder does not exist, so create it
-            node_ids = self.mega.create_folder(self.user_folder_name)
-            logger.info(f'Created new folder: {self.user_folder_name}')
-            self.user_folder_on_mega = node_ids[self.user_folder_name]
-        else:
-            # folder exists
-            self.user_folder_on_mega = user_folder[0]
+
+
+    def _staging_dir_name(self):
+        """Return the name of the temporary directory for the user's downloads."""
+        return (
+            f'igstories_{self.userpk}_{self.username}__'
+            f'{time.strftime(ISO8601, time.gmtime())}'
+        )
+
+
+    def _user_story_items(self) -> 'list[dict]':
+        """Return the user's story items as returned by the private API.
+
+        instagrapi's `user_stories` returns Story models, which lack most of
+        the fields archived by StoryItem (e.g. the dimensions of the image
+        and video versions), so request the raw items like it does.
+        """
+        params = {
+            'supported_capabilities_new': json.dumps(config.SUPPORTED_CAPABILITIES)
+        }
+        reel = self.api.private_request(
+            f'feed/user/{self.userid}/story/', params=params
+        ).get('reel') or {}
+        return reel.get('items', [])
 
 
     def save(self):
-        """Upload all currently available stories to MEGA."""
+        """Upload all currently available stories to the storage."""
 
-        stories = self.api.user_stories(self.userid)
+        stories = self._user_story_items()
         self.story_items_count = len(stories)
 
         if self.story_items_count == 0:
-            logger.info(f'{self.username} (pk {self.userpk}): Currently no story items.')
+            logger.info('%s (pk %s): Currently no story items.', self.username, self.userpk)
             return
 
-        # self._get_user_folder_on_mega()
-        with TemporaryLocalDownloadDir(self.userpk, self.username) as dirname:
-            self.dldir = dirname
+        self._get_user_folder_name()
+        with StagingArea(
+            self._staging_dir_name(), self.budget,
+            in_memory=not self.storage.uploads_from_files
+        ) as staging:
+            self.staging = staging
             for index, story_item in enumerate(stories):
                 try:
-                    logger.info(pformat(story_item))
-                    # StoryItem(self, index, story_item).save()
+                    if logger.isEnabledFor(logging.DEBUG):
+                        # verbose payload dump, only with debug logging
+                        logger.debug(pformat(story_item))
+                    StoryItem(self, index, story_item).save()
                 except Exception:
                     logger.exception(
-                        f'Error while saving story item {index}/'
-                        f'{self.story_items_count - 1} of {self.username} '
-                        f'(pk {self.userpk})!',
+                        'Error while saving story item %d/%d of %s (pk %s)!',
+                        index, self.story_items_count - 1, self.username, self.userpk,
                         exc_info=True
                     )
-                    logger.info(f'Skipped this story item.')
+                    logger.info('Skipped this story item.')
 
 
         return
@@ -111,11 +107,11 @@ class StorySaver():
             user_reel_media: dict = self.api.user_reel_media(self.userid)
         except ClientError as e:
             logger.exception(
-                f'ClientError {e.msg} while getting stories for user {self.userid} '
-                f'(Code: {e.code}, Response: {e.error_response})',
+                'ClientError %s while getting stories for user %s (Code: %s, Response: %s)',
+                e.msg, self.userid, e.code, e.error_response,
                 exc_info=True
             )
-            logger.info(f'Skipped user {self.userid}.')
+            logger.info('Skipped user %s.', self.userid)
             return
 
         try:
@@ -128,26 +124,29 @@ class StorySaver():
             self.story_items_count = user_reel_media.get('media_count')
 
             if user_reel_media.get('latest_reel_media') is None:
-                logger.info(f'{self.username}: Currently no story items.')
+                logger.info('%s: Currently no story items.', self.username)
                 return
 
-            self._get_user_folder_on_mega()
-            with TemporaryLocalDownloadDir(self.userpk, self.username) as dirname:
-                self.dldir = dirname
+            self._get_user_folder_name()
+            with StagingArea(
+                self._staging_dir_name(), self.budget,
+                in_memory=not self.storage.uploads_from_files
+            ) as staging:
+                self.staging = staging
                 for index, story_item in enumerate(self.story_items):
                     try:
                         StoryItem(self, index, story_item).save()
                     except Exception:
                         logger.exception(
-                            f'Error while saving story item {index}/'
-                            f'{self.story_items_count - 1} of {self.username}!',
+                            'Error while saving story item %d/%d of %s!',
+                            index, self.story_items_count - 1, self.username,
                             exc_info=True
                         )
-                        logger.info(f'Skipped this story item.')
+                        logger.info('Skipped this story item.')
 
         except Exception:
-            logger.exception(f'Error during story saving of {self.username}!', exc_info=True)
-            logger.info(f'Skipped {self.username}.')
+            logger.exception('Error during story saving of %s!', self.username, exc_info=True)
+            logger.info('Skipped %s.', self.username)
 
 
 def _get_best_image(media_info_dict: dict) -> dict:
@@ -175,9 +174,9 @@ class StoryItem():
         self.data = data_dict
         self._fill_data_attributes()
         filename_common = datetime.fromtimestamp(self.taken_at, tz=timezone.utc).strftime(ISO8601)
-        self.filename_localdl = os.path.join(self.saver.dldir, filename_common)
-        self.dirname_megaupload = self.saver.user_folder_on_mega
-        self.filename_megaupload = filename_common
+        self.filename_staging = filename_common
+        # e.g. 'userpk_username/2022-01-01T00-00-00Z'
+        self.path_upload = '/'.join([self.saver.user_folder_name, filename_common])
         self.was_last_upload_skipped = False
 
 
@@ -191,37 +190,75 @@ class StoryItem():
         }.get(media_type, f'unknown-mediatype({media_type})')
         self.has_locations = 'story_locations' in self.data
         self.has_feed_media = 'story_feed_media' in self.data
+        self.upload_image = not (
+            self.is_video and self.saver.processor.options.drop_video_cover
+        )
 
     def save(self):
-        """Upload the story item to MEGA."""
+        """Upload the story item to the storage."""
         self._best_image()
         self._best_video()
 
+        # check all files of this story item at once, so that the storage
+        # backend can do it in a single request
+        exts = (
+            ['.json']
+            + (['.jpg'] if self.upload_image else [])
+            + (['.mp4'] if self.is_video else [])
+        )
+        self.existing_uploads = self.saver.storage.exists_many(
+            self.path_upload + ext for ext in exts
+        )
+
+        # download the binaries first, so that their processing overlaps with
+        # the remaining downloads and the JSON upload
+        if self.upload_image:
+            image = self._download_binary('.jpg', self.best_image.get('url'))
+        if self.is_video:
+            video = self._download_binary('.mp4', self.best_video.get('url'))
+
         json_data = self._prepare_json()
 
-        self._upload_json_to_mega(json_data)
+        self._upload_json(json_data)
         self._print_upload_info('JSON')
 
-        self._upload_binary_to_mega('.jpg', self.best_image.get('url'))
-        self._print_upload_info('image')
+        if self.upload_image:
+            self._upload_binary('.jpg', *image)
+            self._print_upload_info('image')
+        else:
+            logger.info(
+                '%s: Skipped uploading image for story %d/%d (video cover dropped).',
+                self.saver.username, self.index, self.saver.story_items_count - 1,
+                extra=self._log_extra('image', 'dropped')
+            )
 
         if self.is_video:
-            self._upload_binary_to_mega('.mp4', self.best_video.get('url'))
+            self._upload_binary('.mp4', *video)
             self._print_upload_info('video')
 
 
     def _print_upload_info(self, type: str):
-        common_str = (
-            f' {type} for story '
-            f'{self.index}/{self.saver.story_items_count - 1} to MEGA'
-        )
         if self.was_last_upload_skipped:
-            logger.info(
-                f'{self.saver.username}: Skipped uploading' +
-                common_str + ' (already exists).'
-            )
+            action, suffix, outcome = 'Skipped uploading', ' (already exists).', 'skipped'
         else:
-            logger.info(f'{self.saver.username}: Uploaded' + common_str + '.')
+            action, suffix, outcome = 'Uploaded', '.', 'uploaded'
+        logger.info(
+            '%s: %s %s for story %d/%d to %s%s',
+            self.saver.username, action, type,
+            self.index, self.saver.story_items_count - 1, self.saver.storage.name, suffix,
+            extra=self._log_extra(type, outcome)
+        )
+
+
+    def _log_extra(self, type: str, outcome: str) -> dict:
+        """Return the structured fields for the log record of an upload."""
+        return {
+            'username': self.saver.username,
+            'userpk': self.saver.userpk,
+            'story_index': self.index,
+            'file_type': type,
+            'outcome': outcome,
+        }
 
 
     def _best_image(self):
@@ -271,18 +308,19 @@ class StoryItem():
         """Get a dict with all relevant location information for each location in the story."""
         for story_location in self.data.get('story_locations', []):
             location_id: str = story_location.get('location', {}).get('pk')
-            location_data: dict = self.saver.api.location_info(location_id).get('location', {})
+            # instagrapi returns a Location model here
+            location_data = self.saver.api.location_info(location_id)
             location_url = OSM_URL_FORMAT.format(
-                lat=location_data.get('lat'), lon=location_data.get('lng')
+                lat=location_data.lat, lon=location_data.lng
             )
             yield {
                 'id': location_id,
-                'name': location_data.get('name'),
-                'city': location_data.get('city'),
-                'address': location_data.get('address'),
+                'name': location_data.name,
+                'city': location_data.city,
+                'address': location_data.address,
                 'coordinates': {
-                    'lat': location_data.get('lat'),
-                    'lon': location_data.get('lng')
+                    'lat': location_data.lat,
+                    'lon': location_data.lng
                 },
                 'url': location_url
             }
@@ -294,7 +332,9 @@ class StoryItem():
             media_id = feed_media.get('media_id')
             if media_id is None:
                 continue
-            media_info = self.saver.api.media_info(media_id).get('items', [])
+            # instagrapi's media_info() returns a Media model without e.g. the
+            # image and video versions, so request the raw media info
+            media_info = self.saver.api.private_request(f'media/{media_id}/info/').get('items', [])
             if len(media_info) == 0:
                 continue
             media_info = media_info[0]
@@ -357,43 +397,66 @@ class StoryItem():
             yield feed_media_dict
 
 
-    def _upload_json_to_mega(self, json_data: dict):
-        """Upload the given dict to a JSON file on MEGA."""
-        ext = '.json'
-        f_local = self.filename_localdl + ext
-        f_mega = self.filename_megaupload + ext
-        # write to local filesystem first
-        with open(f_local, 'w', encoding='utf-8') as f:
-            json.dump(json_data, f, indent=2)
-        # then upload to MEGA
-        self._safe_upload_to_mega(f_local, f_mega)
+    def _upload_json(self, json_data: dict):
+        """Upload the given dict to a JSON file on the storage."""
+        dest_path = self.path_upload + '.json'
+        if self._skip_existing(dest_path):
+            return
+        json_bytes = json.dumps(json_data, indent=2).encode('utf-8')
+        asset = self.saver.staging.stage(self.filename_staging + '.json', len(json_bytes))
+        asset.write(json_bytes)
+        asset.finish()
+        self._put_asset(dest_path, asset)
+
 
+    def _download_binary(self, ext: str, source_url: str) -> 'tuple[StagedAsset|None, Future|None]':
+        """Download the data from the given URL to the staging area.
 
-    def _upload_binary_to_mega(self, ext: str, source_url: str):
-        """Upload the data from the given URL to MEGA."""
-        f_local = self.filename_localdl + ext
-        f_mega = self.filename_megaupload + ext
-        # download data to local filesystem first
+        Start processing the asset right away. Return the asset and the
+        processing future, or None for both if the file already exists on
+        the storage.
+        """
+        if self.path_upload + ext in self.existing_uploads:
+            return None, None
         request = requests.get(source_url, stream=True)
         request.raise_for_status()
-        with open(f_local, 'wb') as f:
-            for chunk in request.iter_content(chunk_size=CHUNK_SIZE):
-                f.write(chunk)
-        # then upload to MEGA
-        self._safe_upload_to_mega(f_local, f_mega)
-
-
-    def _safe_upload_to_mega(self, filename: str, dest_filename: str):
-        """Upload the given file, but only if a file of that name doesn't exist yet."""
-        # mega.find() must be called with 'folder/file.txt', but mega.upload()
-        # must be called with dest='node_id_of_folder', dest_filename='file.txt'
-        filename_to_find = '/'.join([self.saver.user_folder_name, dest_filename])
-        if self.saver.mega.find(filename_to_find, exclude_deleted=True) is not None:
-            # file already exists, skip it
-            self.was_last_upload_skipped = True
-        else:
-            self.was_last_upload_skipped = False
-            self.saver.mega.upload(
-                filename, dest=self.saver.user_folder_on_mega,
-                dest_filename=dest_filename
-            )
+        content_length = request.headers.get('Content-Length')
+        asset = self.saver.staging.stage(
+            self.filename_staging + ext,
+            int(content_length) if content_length else None
+        )
+        for chunk in request.iter_content(chunk_size=CHUNK_SIZE):
+            asset.write(chunk)
+        asset.finish()
+        return asset, self.saver.processor.submit(asset)
+
+
+    def _upload_binary(self, ext: str, asset: 'StagedAsset|None', processing: 'Future|None'):
+        """Upload the staged asset to the storage once it is processed.
+
+        Free the asset right after its upload.
+        """
+        dest_path = self.path_upload + ext
+        if self._skip_existing(dest_path):
+            return
+        self.saver.processor.wait(processing, asset)
+        start = time.monotonic()
+        self._put_asset(dest_path, asset)
+        self.saver.processor.record_upload(asset.size, time.monotonic() - start)
+
+
+    def _put_asset(self, dest_path: str, asset: StagedAsset):
+        """Upload the staged asset to the storage and free it afterwards."""
+        try:
+            if asset.in_memory:
+                self.saver.storage.put_stream(dest_path, asset.reader())
+            else:
+                self.saver.storage.put_file(dest_path, asset.filename)
+        finally:
+            asset.release()
+
+
+    def _skip_existing(self, dest_path: str) -> bool:
+        """Return whether the file must be skipped because it already exists."""
+        self.was_last_upload_skipped = dest_path in self.existing_uploads
+        return self.was_last_upload_skipped
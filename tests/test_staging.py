@@ -0,0 +1,85 @@
+import os
+import tempfile
+
+import pytest
+
+from instagram_dl_to_mega_instagrapi.staging import (
+    StagingArea, TempSpaceBudget, TempSpaceExhaustedError
+)
+
+
+@pytest.fixture(autouse=True)
+def tempdir(tmp_path, monkeypatch):
+    # StagingArea creates its directory in the temp directory
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    return tmp_path
+
+
+def test_small_asset_stays_in_memory():
+    budget = TempSpaceBudget(total=100, memory_threshold=10)
+    with StagingArea('staging', budget) as area:
+        asset = area.stage('story.jpg')
+        asset.write(b'1234')
+        asset.finish()
+        assert asset.in_memory
+        assert asset.reader().read() == b'1234'
+        assert budget.available == 100
+
+
+def test_spill_when_crossing_the_threshold():
+    budget = TempSpaceBudget(total=100, memory_threshold=10)
+    with StagingArea('staging', budget) as area:
+        asset = area.stage('story.jpg')
+        asset.write(b'12345678')
+        assert asset.in_memory
+        asset.write(b'9012')
+        assert not asset.in_memory
+        asset.finish()
+        with open(asset.filename, 'rb') as f:
+            assert f.read() == b'123456789012'
+        assert budget.available == 100 - 12
+
+
+def test_finish_releases_over_reservation():
+    budget = TempSpaceBudget(total=100, memory_threshold=10)
+    with StagingArea('staging', budget) as area:
+        # the announced size is reserved up front
+        asset = area.stage('story.mp4', expected_size=50)
+        assert not asset.in_memory
+        assert budget.available == 50
+        asset.write(b'x' * 20)
+        asset.finish()
+        assert budget.available == 80
+
+
+def test_release_restores_budget():
+    budget = TempSpaceBudget(total=100, memory_threshold=10)
+    with StagingArea('staging', budget) as area:
+        asset = area.stage('story.mp4', expected_size=30)
+        asset.write(b'x' * 30)
+        asset.finish()
+        filename = asset.filename
+        asset.release()
+        assert budget.available == 100
+        assert not os.path.exists(filename)
+        assert not area.assets
+
+
+def test_exit_releases_remaining_assets(tempdir):
+    budget = TempSpaceBudget(total=100, memory_threshold=10)
+    with StagingArea('staging', budget) as area:
+        area.stage('story.mp4', expected_size=30).write(b'x' * 30)
+    assert budget.available == 100
+    assert not os.path.exists(tempdir / 'staging')
+
+
+def test_exhausted_budget_fails_fast():
+    budget = TempSpaceBudget(total=40, memory_threshold=10)
+    with StagingArea('staging', budget) as area:
+        area.stage('first.mp4', expected_size=30)
+        with pytest.raises(TempSpaceExhaustedError) as exc_info:
+            area.stage('second.mp4', expected_size=30)
+        assert (exc_info.value.nbytes, exc_info.value.available, exc_info.value.total) == (30, 10, 40)
+        with pytest.raises(TempSpaceExhaustedError):
+            area.stage('third.mp4').write(b'x' * 20)
+    assert budget.available == 40
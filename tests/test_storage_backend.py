@@ -0,0 +1,68 @@
+import io
+import os
+
+import pytest
+
+from instagram_dl_to_mega_instagrapi.storage_backend import LocalStorage
+
+
+class _FailingStream(io.BytesIO):
+    def read(self, *args):
+        raise OSError('connection lost')
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path / 'archive'))
+
+
+def test_exists_many(storage):
+    storage.put_stream('top.json', io.BytesIO(b'{}'))
+    storage.put_stream('user/story.jpg', io.BytesIO(b'jpg'))
+    assert storage.exists_many(
+        ['top.json', 'user/story.jpg', 'user/story.mp4', 'other/top.json']
+    ) == {'top.json', 'user/story.jpg'}
+    assert storage.exists('user/story.jpg')
+    assert not storage.exists('user')
+
+
+def test_put_stream_writes_readable_file(storage):
+    storage.put_stream('user/story.json', io.BytesIO(b'{}'))
+    local_path = os.path.join(storage.root, 'user', 'story.json')
+    with open(local_path, 'rb') as f:
+        assert f.read() == b'{}'
+    assert os.stat(local_path).st_mode & 0o777 == 0o644
+
+
+def test_put_stream_cleans_up_on_failure(storage):
+    storage.put_stream('user/story.json', io.BytesIO(b'old'))
+    with pytest.raises(OSError):
+        storage.put_stream('user/story.json', _FailingStream())
+    # neither a temporary file is left behind nor the old file replaced
+    assert os.listdir(os.path.join(storage.root, 'user')) == ['story.json']
+    with open(os.path.join(storage.root, 'user', 'story.json'), 'rb') as f:
+        assert f.read() == b'old'
+
+
+def test_get(storage, tmp_path):
+    storage.put_stream('story.json', io.BytesIO(b'{}'))
+    local_filename = str(tmp_path / 'downloaded.json')
+    assert storage.get('story.json', local_filename)
+    with open(local_filename, 'rb') as f:
+        assert f.read() == b'{}'
+
+
+def test_get_missing_file(storage, tmp_path):
+    local_filename = str(tmp_path / 'downloaded.json')
+    assert not storage.get('missing.json', local_filename)
+    assert not os.path.exists(local_filename)
+
+
+def test_delete(storage):
+    storage.put_stream('user/story.json', io.BytesIO(b'{}'))
+    storage.delete('user/story.json')
+    assert not storage.exists('user/story.json')
+
+
+def test_delete_missing_file(storage):
+    storage.delete('user/missing.json')